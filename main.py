@@ -1,10 +1,17 @@
 import os
-import base64
+import asyncio
+import time
+import queue
+import threading
 import traceback
+from functools import lru_cache
+from operator import attrgetter
+import orjson
+import pybase64
 from dotenv import load_dotenv
 from pymongo import MongoClient
 from transformers import pipeline
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, stream_with_context
 from llama_cloud_services import LlamaParse
 
 load_dotenv()
@@ -18,13 +25,184 @@ MONGO_CONNECTION_STRING = os.getenv("MONGO_CONNECTION_STRING")
 LLAMA_CLOUD_API_KEY = os.environ.get("LLAMA_CLOUD_API_KEY")
 
 MAX_SIZE = 20 * 1024 * 1024
-
-classifier = pipeline("zero-shot-classification", model="facebook/bart-large-mnli")
+# Room for the multipart boundaries and part headers around the file itself
+MULTIPART_OVERHEAD = 64 * 1024
+ALLOWED_EXT = frozenset({'.ppt', '.pptx', '.pdf', '.png', '.jpg', '.jpeg'})
+IMAGE_EXT = frozenset({'.png', '.jpg', '.jpeg'})
+PAGE_DEFAULTS = {'text': '', 'md': '', 'images': [], 'layout': {}, 'structuredData': {}}
+PAGE_FIELDS = tuple(PAGE_DEFAULTS)
+# Multiple of 3 so each chunk encodes without padding and the pieces concatenate cleanly
+B64_CHUNK_SIZE = 48 * 1024
+
+app.config['MAX_CONTENT_LENGTH'] = MAX_SIZE + MULTIPART_OVERHEAD
+
+# LlamaParse caches an httpx.AsyncClient bound to the event loop of its first use, so each
+# request thread keeps its own long-lived loop and parser to reuse connections across requests
+parse_state = threading.local()
+
+def get_parse_loop():
+    if not hasattr(parse_state, 'loop'):
+        parse_state.loop = asyncio.new_event_loop()
+    return parse_state.loop
+
+def get_parser():
+    # num_workers is left at its default: LlamaParse only uses it for multi-file batches and
+    # target_pages partitions, never for the single unpartitioned upload parsed here
+    if not hasattr(parse_state, 'parser'):
+        parse_state.parser = LlamaParse(
+            api_key=LLAMA_CLOUD_API_KEY,
+            verbose=False,
+            language="en",
+        )
+    return parse_state.parser
+
+async def parse_upload(parser, file_bytes, file_name, with_images):
+    # Parse and image download share one event loop, since the result reuses the parser's AsyncClient
+    result = await parser.aparse(file_bytes, extra_info={'file_name': file_name})
+    image_documents = []
+    if with_images:
+        image_documents = await result.aget_image_documents(
+            include_screenshot_images=True,
+            include_object_images=False,
+            image_download_dir="./images",
+        )
+    return result, image_documents
+
+# Shared across requests; PyMongo's connection pool is thread-safe
+mongo_client = MongoClient(MONGO_CONNECTION_STRING, maxPoolSize=50, serverSelectionTimeoutMS=5000)
+teams_collection = mongo_client['sih-reg']['teams']
+
+# Resolves each team's problem statement server-side in a single round trip
+TEAMS_PIPELINE = [
+    {'$project': {'teamName': 1, 'tasks.files': 1, 'problemStatement': 1, '_id': 0}},
+    # problemStatement may be stored as an ObjectId or as its hex string
+    {'$addFields': {'psId': {'$convert': {
+        'input': '$problemStatement', 'to': 'objectId', 'onError': None, 'onNull': None,
+    }}}},
+    {'$lookup': {
+        'from': 'problemstatements',
+        'localField': 'psId',
+        'foreignField': '_id',
+        'as': 'ps',
+    }},
+    {'$unwind': {'path': '$ps', 'preserveNullAndEmptyArrays': True}},
+    {'$project': {
+        '_id': 0,
+        'teamName': {'$ifNull': ['$teamName', None]},
+        'pptLinks': {'$reduce': {
+            'input': {'$ifNull': ['$tasks.files', []]},
+            'initialValue': [],
+            'in': {'$concatArrays': ['$$value', {'$ifNull': ['$$this', []]}]},
+        }},
+        'problemStatement': {'$convert': {
+            'input': '$problemStatement', 'to': 'string', 'onError': None, 'onNull': None,
+        }},
+        'psTitle': {'$ifNull': ['$ps.title', None]},
+        'psDescription': {'$ifNull': ['$ps.description', None]},
+    }},
+]
+
+# int8 ONNX export produced by quantize_model.py; falls back to the FP32 PyTorch model if absent
+CLASSIFIER_MODEL_DIR = "bart-mnli-int8"
+
+if os.path.isdir(CLASSIFIER_MODEL_DIR):
+    from optimum.pipelines import pipeline as ort_pipeline
+    classifier = ort_pipeline("zero-shot-classification", model=CLASSIFIER_MODEL_DIR, accelerator="ort")
+else:
+    classifier = pipeline("zero-shot-classification", model="facebook/bart-large-mnli")
+
+DETECT_LABELS = ["AI-Generated", "Human-Written"]
+DETECT_BATCH_SIZE = 16
+DETECT_BATCH_WINDOW = 0.010
+# BART-MNLI only sees 1024 tokens; cap the input so the tokenizer never walks huge blobs
+DETECT_MAX_CHARS = 4096
+
+detect_queue = queue.Queue()
+
+def detect_worker():
+    # Collect requests that arrive within a short window and run them through the model together
+    while True:
+        jobs = [detect_queue.get()]
+        deadline = time.monotonic() + DETECT_BATCH_WINDOW
+        while len(jobs) < DETECT_BATCH_SIZE:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                jobs.append(detect_queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        try:
+            # The pipeline defaults to batch_size=1; zero-shot runs one forward item per (text, label) pair
+            results = classifier(
+                [job['text'] for job in jobs],
+                candidate_labels=DETECT_LABELS,
+                batch_size=len(jobs) * len(DETECT_LABELS),
+            )
+            if isinstance(results, dict):
+                results = [results]
+            for job, res in zip(jobs, results):
+                job['result'] = (res["labels"][0], float(res["scores"][0]))
+        except Exception as e:
+            for job in jobs:
+                job['error'] = e
+        finally:
+            for job in jobs:
+                job['done'].set()
+
+threading.Thread(target=detect_worker, daemon=True).start()
 
 def detect_ai_or_human(text):
-    labels = ["AI-Generated", "Human-Written"]
-    results = classifier(text, candidate_labels=labels)
-    return results["labels"][0], float(results["scores"][0])
+    job = {'text': text, 'done': threading.Event(), 'result': None, 'error': None}
+    detect_queue.put(job)
+    job['done'].wait()
+    if job['error'] is not None:
+        raise job['error']
+    return job['result']
+
+# Repeated submissions of the same text skip the queue and the forward pass entirely
+@lru_cache(maxsize=1024)
+def detect_cached(text):
+    return detect_ai_or_human(text)
+
+def ojson(data):
+    return app.response_class(orjson.dumps(data), mimetype='application/json')
+
+def pages_to_dicts(pages, fields=PAGE_FIELDS):
+    # attrgetter returns a bare value instead of a tuple when given a single field
+    getter = attrgetter(*fields) if len(fields) > 1 else None
+    result = []
+    for page in pages:
+        try:
+            values = getter(page) if getter else [getattr(page, field) for field in fields]
+        except AttributeError:
+            values = [getattr(page, field, PAGE_DEFAULTS[field]) for field in fields]
+        result.append(dict(zip(fields, values)))
+    return result
+
+def stream_b64(buf):
+    view = memoryview(buf)
+    for i in range(0, len(view), B64_CHUNK_SIZE):
+        yield pybase64.b64encode(view[i:i + B64_CHUNK_SIZE])
+
+def image_response(message, images_info, pages_json):
+    # Stream the base64 payload in chunks rather than building the whole string in memory
+    def generate():
+        yield b'{"message": ' + orjson.dumps(message) + b', "images": ['
+        for i, (img_bytes, description) in enumerate(images_info):
+            if i:
+                yield b', '
+            yield b'{"image_base64": "'
+            yield from stream_b64(img_bytes)
+            yield b'", "description": ' + orjson.dumps(description) + b'}'
+        yield b'], "pages": ' + pages_json + b'}'
+
+    return Response(stream_with_context(generate()), status=200, mimetype='application/json')
+
+@app.errorhandler(413)
+def request_too_large(e):
+    return ojson({'error': 'File too large. Max size is 20MB.'}), 413
 
 @app.route('/')
 def index():
@@ -39,84 +217,66 @@ def index():
 @app.route('/upload', methods=['POST'])
 def upload_file():
     if 'file' not in request.files:
-        return jsonify({'error': 'No file part in the request.'}), 400
+        return ojson({'error': 'No file part in the request.'}), 400
     file = request.files['file']
     if file.filename == '':
-        return jsonify({'error': 'No file selected for upload.'}), 400
-    allowed_ext = ('.ppt', '.pptx', '.pdf', '.png', '.jpg', '.jpeg')
-    if not (file and file.filename.lower().endswith(allowed_ext)):
-        return jsonify({'error': 'Invalid file type. Only PPT, PPTX, PDF, PNG, JPG, or JPEG allowed.'}), 400
-    file.seek(0, os.SEEK_END)
-    file_length = file.tell()
-    file.seek(0)
-
-    if file_length > MAX_SIZE:
-        return jsonify({'error': 'File too large. Max size is 20MB.'}), 400
+        return ojson({'error': 'No file selected for upload.'}), 400
+    ext = os.path.splitext(file.filename)[1].lower()
+    if ext not in ALLOWED_EXT:
+        return ojson({'error': 'Invalid file type. Only PPT, PPTX, PDF, PNG, JPG, or JPEG allowed.'}), 400
+
+    # Optional ?fields=text,md projection so large layout/structuredData trees can be skipped
+    fields = PAGE_FIELDS
+    if 'fields' in request.args:
+        requested = {field.strip() for field in request.args['fields'].split(',')} - {''}
+        if not requested or not requested <= set(PAGE_FIELDS):
+            return ojson({'error': f"Invalid 'fields'. Choose one or more of: {', '.join(PAGE_FIELDS)}."}), 400
+        fields = tuple(field for field in PAGE_FIELDS if field in requested)
 
     try:
-        filepath = os.path.join(UPLOAD_FOLDER, file.filename)
-        file.save(filepath)
+        file_bytes = file.read()
     except Exception as e:
-        return jsonify({'error': 'Failed to save file.', 'details': str(e)}), 500
-    
-    api_key = LLAMA_CLOUD_API_KEY
+        return ojson({'error': 'Failed to read file.', 'details': str(e)}), 500
 
-    if not api_key:
-        return jsonify({'error': 'LlamaParse API key not set in environment.'}), 500
-    
-    parser = LlamaParse(
-        api_key=api_key,
-        num_workers=4,
-        verbose=True,
-        language="en",
-    )
+    # MAX_CONTENT_LENGTH bounds the whole body; this enforces the limit on the file itself
+    if len(file_bytes) > MAX_SIZE:
+        return ojson({'error': 'File too large. Max size is 20MB.'}), 400
 
-    try:
-        result = parser.parse(filepath)
-        ext = os.path.splitext(file.filename)[1].lower()
-        if ext in ['.png', '.jpg', '.jpeg']:
-            image_documents = result.get_image_documents(
-                include_screenshot_images=True,
-                include_object_images=False,
-                image_download_dir="./images",
-            )
+    # Images are echoed back as-is unless the client explicitly asks for ?parse=1
+    if ext in IMAGE_EXT and request.args.get('parse') != '1':
+        return image_response(
+            'Image uploaded successfully',
+            [(file_bytes, '')],
+            b'[]',
+        )
 
-            images_info = []
-            for img_doc in image_documents:
-                img_b64 = base64.b64encode(img_doc.image_bytes).decode('utf-8')
-                images_info.append({
-                    'image_base64': img_b64,
-                    'description': getattr(img_doc, 'description', ''),
-                })
+    if not LLAMA_CLOUD_API_KEY:
+        return ojson({'error': 'LlamaParse API key not set in environment.'}), 500
+    parser = get_parser()
+
+    try:
+        # Hand the upload to LlamaParse in memory rather than round-tripping through disk
+        result, image_documents = get_parse_loop().run_until_complete(
+            parse_upload(parser, file_bytes, file.filename, ext in IMAGE_EXT)
+        )
+        if ext in IMAGE_EXT:
+            images_info = [
+                (img_doc.image_bytes, getattr(img_doc, 'description', ''))
+                for img_doc in image_documents
+            ]
 
             if not images_info:
-                with open(filepath, 'rb') as f:
-                    img_bytes = f.read()
-                img_b64 = base64.b64encode(img_bytes).decode('utf-8')
-                images_info.append({
-                    'image_base64': img_b64,
-                    'description': 'Uploaded image (no description from parser)',
-                })
-
-            pages = []
-            for page in result.pages:
-                pages.append({
-                    'text': getattr(page, 'text', ''),
-                    'md': getattr(page, 'md', ''),
-                    'images': getattr(page, 'images', []),
-                    'layout': getattr(page, 'layout', {}),
-                    'structuredData': getattr(page, 'structuredData', {}),
-                })
-            return jsonify({
-                'message': 'Image uploaded and parsed successfully', 
-                'images': images_info, 
-                'pages': pages
-            }), 200
+                images_info.append((file_bytes, 'Uploaded image (no description from parser)'))
+
+            pages = pages_to_dicts(result.pages, fields)
+            pages_json = orjson.dumps(pages)
+
+            return image_response('Image uploaded and parsed successfully', images_info, pages_json)
         
         else:
             markdown_documents = result.get_markdown_documents(split_by_page=True)
             markdown_strings = [doc.markdown if hasattr(doc, 'markdown') else str(doc) for doc in markdown_documents]
-            return jsonify({
+            return ojson({
                 'message': 'File uploaded and parsed successfully',
                 'markdown_documents': markdown_strings
             }), 200
@@ -128,7 +288,7 @@ def upload_file():
         print(tb)
 
         if 'DNS resolution failed' in err_msg or 'Name or service not known' in err_msg:
-            return jsonify({
+            return ojson({
                 'error': 'DNS resolution failed. Cannot reach LlamaParse API.',
                 'suggestions': [
                     'Check your internet connection',
@@ -140,7 +300,7 @@ def upload_file():
             }), 500
         
         if '401' in err_msg or 'Unauthorized' in err_msg or 'Invalid token format' in err_msg:
-            return jsonify({
+            return ojson({
                 'error': 'LlamaParse API key is invalid or expired.',
                 'suggestions': [
                     'Check your API key',
@@ -150,103 +310,64 @@ def upload_file():
                 'traceback': tb
             }), 401
         
-        return jsonify({'error': 'LlamaParse Python client failed', 'py_error': err_msg, 'traceback': tb}), 500
+        return ojson({'error': 'LlamaParse Python client failed', 'py_error': err_msg, 'traceback': tb}), 500
 
 @app.route('/api/teams', methods=['GET'])
 def get_teams():
     try:
-        client = MongoClient(MONGO_CONNECTION_STRING)
-        db = client['sih-reg']
-        teams_collection = db['teams']
-        ps_collection = db['problemstatements']
-
-        teams_data = []
-        for team in teams_collection.find({}, { 'teamName': 1, 'tasks.files': 1, 'problemStatement': 1, '_id': 0 }):
-            ppt_links = []
-            if 'tasks' in team:
-                for task in team['tasks']:
-                    if 'files' in task and task['files']:
-                        ppt_links.extend(task['files'])
-
-            # Return the object that is two down from teamName (problemStatement as string if ObjectId)
-            from bson import ObjectId
-            ps = team.get('problemStatement')
-            ps_id = None
-            if isinstance(ps, ObjectId):
-                ps_id = ps
-                ps = str(ps)
-            elif isinstance(ps, dict) and '$oid' in ps:
-                ps_id = ObjectId(ps['$oid'])
-                ps = ps['$oid']
-            elif isinstance(ps, str):
-                try:
-                    ps_id = ObjectId(ps)
-                except Exception:
-                    ps_id = None
-
-            # Fetch the title from problemstatements collection
-            ps_title = None
-            ps_description = None
-            if ps_id:
-                ps_obj = ps_collection.find_one({'_id': ps_id})
-                if ps_obj:
-                    if 'title' in ps_obj:
-                        ps_title = ps_obj['title']
-                    if 'description' in ps_obj:
-                        ps_description = ps_obj['description']
-
-            team_data = {
-                'teamName': team.get('teamName'),
-                'pptLinks': ppt_links,
-                'problemStatement': ps,
-                'psTitle': ps_title,
-                'psDescription': ps_description
-            }
-            teams_data.append(team_data)
-
-        client.close()
-        return jsonify(teams_data), 200
+        teams_data = list(teams_collection.aggregate(TEAMS_PIPELINE, batchSize=1000, allowDiskUse=False))
+        return ojson(teams_data), 200
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return ojson({'error': str(e)}), 500
     
 @app.route('/clean_uploads', methods=['DELETE'])
 def clean_uploads():
     try:
         if not os.path.exists(UPLOAD_FOLDER):
-            return jsonify({"message": "Uploads folder does not exist"}), 404
+            return ojson({"message": "Uploads folder does not exist"}), 404
 
         deleted_files = []
-        for filename in os.listdir(UPLOAD_FOLDER):
-            file_path = os.path.join(UPLOAD_FOLDER, filename)
-            try:
-                if os.path.isfile(file_path):
-                    os.remove(file_path)
-                    deleted_files.append(filename)
-            except Exception as e:
-                return jsonify({"error": f"Error deleting {filename}: {str(e)}"}), 500
+        errors = []
+        with os.scandir(UPLOAD_FOLDER) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file(follow_symlinks=False):
+                        os.unlink(entry.path)
+                        deleted_files.append(entry.name)
+                except FileNotFoundError:
+                    pass
+                except Exception as e:
+                    errors.append(f"Error deleting {entry.name}: {str(e)}")
+
+        if errors:
+            return ojson({
+                "error": "Some files could not be deleted",
+                "errors": errors,
+                "deleted_files": deleted_files
+            }), 500
 
-        return jsonify({
+        return ojson({
             "message": "Uploads folder cleaned successfully",
             "deleted_files": deleted_files
         }), 200
 
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return ojson({"error": str(e)}), 500
 
 
 @app.route("/detect", methods=["POST"])
 def detect():
     data = request.get_json()
 
-    if not data or "text" not in data:
-        return jsonify({"error": "Invalid request. Please provide 'text' field."}), 400
+    if not isinstance(data, dict) or not isinstance(data.get("text"), str):
+        return ojson({"error": "Invalid request. Please provide 'text' field."}), 400
 
-    text = data["text"]
-    label, score = detect_ai_or_human(text)
+    text = data["text"][:DETECT_MAX_CHARS]
+    label, score = detect_cached(text)
 
     score = int(score * 10)
 
-    return jsonify({
+    return ojson({
         "label": label,
         "score": score
     })
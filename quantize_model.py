@@ -0,0 +1,19 @@
+from transformers import AutoTokenizer
+from optimum.onnxruntime import ORTModelForSequenceClassification, ORTQuantizer
+from optimum.onnxruntime.configuration import AutoQuantizationConfig
+
+BASE_MODEL = "facebook/bart-large-mnli"
+ONNX_DIR = "bart-mnli-onnx"
+INT8_DIR = "bart-mnli-int8"
+
+if __name__ == '__main__':
+    model = ORTModelForSequenceClassification.from_pretrained(BASE_MODEL, export=True)
+    model.save_pretrained(ONNX_DIR)
+
+    # Dynamic int8 quantization; ONNX Runtime picks VNNI kernels at runtime where available
+    quantizer = ORTQuantizer.from_pretrained(ONNX_DIR)
+    quantizer.quantize(
+        save_dir=INT8_DIR,
+        quantization_config=AutoQuantizationConfig.avx512_vnni(is_static=False),
+    )
+    AutoTokenizer.from_pretrained(BASE_MODEL).save_pretrained(INT8_DIR)